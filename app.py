@@ -3,17 +3,16 @@ import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime, date, timedelta
-import hashlib
+import secrets
+import random
+import threading
+import time
 from io import BytesIO
-import base64
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import plotly.express as px
 
-# PDF (ticket)
-from reportlab.lib.pagesizes import A6
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from reportlab.lib import colors
+# plotly (dashboard) y reportlab (ticket PDF) se importan dentro de las
+# funciones que los usan: la mayoría de visitas son de choferes y no los necesitan.
 
 
 # ----------------------------
@@ -23,7 +22,7 @@ st.set_page_config(page_title="Citas de Unidades (por turnos)", layout="wide")
 
 WORKSHEET_NAME = "citas"
 
-ESTADOS = ["EN COLA", "EN PROCESO", "ATENDIDO", "CANCELADO"]
+ESTADOS = ("EN COLA", "EN PROCESO", "ATENDIDO", "CANCELADO")
 
 TURNOS_BASE = [
     {"turno": "Turno 1", "horario": "08:00 - 10:00", "capacidad": 4},
@@ -32,7 +31,15 @@ TURNOS_BASE = [
     {"turno": "Turno 4", "horario": "15:00 - 16:30", "capacidad": 4},
 ]
 
-COLUMNAS = [
+TURNO_NAMES = tuple(t["turno"] for t in TURNOS_BASE)
+
+TIPOS_OPERACION = ("Carga", "Descarga", "Importación", "Exportación")
+
+# Opciones de los filtros del panel admin
+FILTRO_ESTADOS = ("(Todos)",) + ESTADOS
+FILTRO_TURNOS = ("(Todos)",) + TURNO_NAMES
+
+COLUMNAS = (
     "id_ticket",
     "turno",
     "horario_turno",
@@ -49,36 +56,26 @@ COLUMNAS = [
     "creado_en",
     "registrado_por",
     "telefono_registro",
-]
+)
 
 
 # ----------------------------
 # Branding (LOGO + FONDO)
 # ----------------------------
 ASSETS_DIR = Path(__file__).parent / "assets"
+STATIC_DIR = Path(__file__).parent / "static"  # servido por Streamlit en app/static/
 LOGO_PATH = ASSETS_DIR / "logo.png"
-FONDO_PATH = ASSETS_DIR / "fondo.png"
-
-
-def _img_to_base64(path: Path) -> str:
-    if not path.exists():
-        return ""
-    b = path.read_bytes()
-    ext = path.suffix.lower().replace(".", "")
-    if ext == "jpg":
-        ext = "jpeg"
-    return f"data:image/{ext};base64," + base64.b64encode(b).decode("utf-8")
+FONDO_PATH = STATIC_DIR / "fondo.png"
+FONDO_URL = "app/static/fondo.png"
 
 
-logo_b64 = _img_to_base64(LOGO_PATH)
-fondo_b64 = _img_to_base64(FONDO_PATH)
-
 # CSS para que los inputs NO “se pierdan” con el fondo
-st.markdown(
-    f"""
+@st.cache_resource
+def _app_css() -> str:
+    return f"""
     <style>
     .stApp {{
-        background: url("{fondo_b64}") no-repeat center center fixed;
+        background: url("{FONDO_URL}") no-repeat center center fixed;
         background-size: cover;
     }}
 
@@ -128,9 +125,16 @@ st.markdown(
         border-radius: 10px !important;
     }}
     </style>
-    """,
-    unsafe_allow_html=True,
-)
+    """
+
+
+def _inject_css():
+    # Se emite en cada rerun: Streamlit quita del DOM lo que no se vuelve a dibujar.
+    # Con el fondo servido como estático, el bloque pesa ~1.5 KB.
+    st.markdown(_app_css(), unsafe_allow_html=True)
+
+
+_inject_css()
 
 
 def header_brand():
@@ -158,6 +162,29 @@ def get_client():
     return gspread.authorize(creds)
 
 
+# Backoff ante cuota (429) y errores transitorios de Google; jitter para no reintentar todos a la vez
+_REINTENTOS = (0.5, 1, 2, 4)
+_HTTP_TRANSITORIOS = (429, 500, 502, 503)
+
+
+def con_reintentos(fn, *args, solo_cuota: bool = False, **kwargs):
+    """
+    Llama fn(*args, **kwargs) reintentando ante APIError transitorio.
+    solo_cuota=True: reintenta solo 429 (escrituras no idempotentes como append,
+    donde un 5xx pudo haber quedado aplicado y reintentar duplicaría la fila).
+    """
+    codigos = (429,) if solo_cuota else _HTTP_TRANSITORIOS
+    for espera in _REINTENTOS:
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in codigos:
+                raise
+            time.sleep(espera + random.uniform(0, 0.3))
+    return fn(*args, **kwargs)
+
+
+@st.cache_resource
 def get_sheet():
     sheet_id = st.secrets.get("SHEET_ID", "").strip()
     # IMPORTANTE: aquí debe ir SOLO el ID, no la URL
@@ -166,20 +193,38 @@ def get_sheet():
         raise RuntimeError("SHEET_ID inválido. Debe ser SOLO el ID del spreadsheet (sin URL).")
 
     gc = get_client()
-    sh = gc.open_by_key(sheet_id)
-    ws = sh.worksheet(WORKSHEET_NAME)
-    ensure_columns(ws)
+    sh = con_reintentos(gc.open_by_key, sheet_id)
+    ws = con_reintentos(sh.worksheet, WORKSHEET_NAME)
+    # El header queda junto al worksheet (ver sheet_headers para el refresco)
+    ws._cached_headers = (time.time(), ensure_columns(ws))
     return ws
 
 
-def ensure_columns(ws):
-    headers = ws.row_values(1)
+def ensure_columns(ws) -> list:
+    """
+    Garantiza que existan todas las COLUMNAS y devuelve el header final de la hoja.
+    """
+    headers = con_reintentos(ws.row_values, 1)
     if not headers:
-        ws.append_row(COLUMNAS)
-        return
+        con_reintentos(ws.append_row, list(COLUMNAS), solo_cuota=True)
+        return list(COLUMNAS)
     missing = [c for c in COLUMNAS if c not in headers]
     if missing:
-        ws.update("A1", [headers + missing])
+        con_reintentos(ws.update, [headers + missing], "A1")
+    return headers + missing
+
+
+HEADER_TTL = 60  # segundos
+
+
+def sheet_headers(ws, refrescar: bool = False) -> list:
+    # Header cacheado junto al worksheet; se relee cada HEADER_TTL por si alguien
+    # insertó o movió columnas a mano con la app corriendo
+    ts, headers = getattr(ws, "_cached_headers", (0.0, None))
+    if refrescar or not headers or time.time() - ts > HEADER_TTL:
+        headers = con_reintentos(ws.row_values, 1)
+        ws._cached_headers = (time.time(), headers)
+    return headers
 
 
 def _norm_str(x) -> str:
@@ -194,54 +239,170 @@ def _norm_date_text(x) -> str:
     return s.lstrip("'").strip()
 
 
-def read_all(ws) -> pd.DataFrame:
-    data = ws.get_all_records()
-    df = pd.DataFrame(data)
-    if df.empty:
-        df = pd.DataFrame(columns=COLUMNAS)
+def _norm_text(s: pd.Series) -> pd.Series:
+    return s.fillna("").astype(str).str.strip().str.lstrip("'").str.strip()
+
+
+def _norm_fecha(s: pd.Series) -> pd.Series:
+    # fecha_cita canónica "%Y-%m-%d" aunque venga a mano como "14/02/2026";
+    # solo se reescriben las filas en otro formato, lo ilegible se deja tal cual
+    fecha = _norm_text(s)
+    resto = ~fecha.str.fullmatch(r"\d{4}-\d{2}-\d{2}") & (fecha != "")
+    if resto.any():
+        parsed = parse_fechas(fecha[resto])
+        fecha = fecha.where(~resto, parsed.dt.strftime("%Y-%m-%d").where(parsed.notna(), fecha[resto]))
+    return fecha
+
+
+def _read_sheet(ws) -> pd.DataFrame:
+    # Lista de listas (ya rellenada a rectángulo) -> DataFrame directo,
+    # sin construir un dict por fila como get_all_records
+    values = con_reintentos(ws.get_values)
+    if len(values) > 1:
+        df = pd.DataFrame(values[1:], columns=values[0])
+    else:
+        df = pd.DataFrame(columns=list(COLUMNAS))
+
+    # Orden de COLUMNAS y columnas faltantes en "" en una sola asignación
+    df = df.reindex(columns=list(COLUMNAS), fill_value="")
+
+    # Normalizaciones útiles (mismas reglas que _norm_date_text, vectorizadas)
+    for c in ["turno", "estado", "creado_en", "telefono_registro"]:
+        df[c] = _norm_text(df[c])
+
+    df["fecha_cita"] = _norm_fecha(df["fecha_cita"])
+
+    # Texto en arrays Arrow (no un objeto str de Python por celda)
+    df = df.convert_dtypes(dtype_backend="pyarrow")
+    return _categorizar(df)
+
+
+def _categorizar(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    estado/turno/tipo_operacion como Categorical: comparaciones y groupby sobre códigos int8.
+    Se conservan valores fuera de catálogo (p.ej. vacíos) como categorías extra.
+    """
+    for col, base in (("estado", ESTADOS), ("turno", TURNO_NAMES), ("tipo_operacion", TIPOS_OPERACION)):
+        valores = df[col].astype(str)
+        extras = sorted(set(valores.unique()) - set(base))
+        df[col] = pd.Categorical(valores, categories=list(base) + extras)
+    return df
 
-    for c in COLUMNAS:
-        if c not in df.columns:
-            df[c] = ""
 
-    # Normalizaciones útiles
-    df["fecha_cita"] = df["fecha_cita"].astype(str).apply(_norm_date_text)
-    df["turno"] = df["turno"].astype(str).apply(_norm_str)
-    df["estado"] = df["estado"].astype(str).apply(_norm_str)
+# Cache por sesión: evita releer la hoja entre tabs y reruns cercanos.
+# update_estados_por_row actualiza la copia local; append_citas la descarta.
+DF_CACHE_TTL = 15  # segundos
 
-    return df[COLUMNAS]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _read_all_cached(sheet_id: str, ws_name: str) -> pd.DataFrame:
+    # Compartido entre sesiones; se limpia tras cada escritura (append/update)
+    return _read_sheet(get_sheet())
+
+
+def read_all(ws) -> pd.DataFrame:
+    # Copia superficial: los llamadores solo agregan columnas (__row, fecha_cita_dt),
+    # no modifican valores, así que no hace falta duplicar los datos
+    ts, cached = st.session_state.get("df_cache", (0.0, None))
+    if cached is not None and time.time() - ts < DF_CACHE_TTL:
+        return cached.copy(deep=False)
+    df = _read_all_cached(ws.spreadsheet_id, ws.title)
+    st.session_state["df_cache"] = (time.time(), df)
+    return df.copy(deep=False)
+
+
+def _cache_set_estado(row_number: int, nuevo_estado: str):
+    ts, cached = st.session_state.get("df_cache", (0.0, None))
+    if cached is None:
+        return
+    pos = row_number - 2  # header=1
+    if 0 <= pos < len(cached) and nuevo_estado in cached["estado"].cat.categories:
+        cached.iloc[pos, cached.columns.get_loc("estado")] = nuevo_estado
+    else:
+        st.session_state.pop("df_cache", None)
+
+
+def parse_fechas(s: pd.Series) -> pd.Series:
+    # Camino rápido: la app siempre escribe "%Y-%m-%d".
+    # Solo lo que no calce (registros antiguos/editados a mano) pasa por el parse robusto.
+    parsed = pd.to_datetime(s, format="%Y-%m-%d", errors="coerce", cache=True)
+    resto = parsed.isna() & (s != "")
+    if resto.any():
+        # format="mixed": cada fila se interpreta por separado (sin inferir un
+        # formato de la primera fila y aplicarlo al resto)
+        parsed[resto] = pd.to_datetime(s[resto], format="mixed", dayfirst=True, errors="coerce")
+    return parsed
 
 
 def generar_ticket():
-    return "TKT-" + hashlib.sha1(str(datetime.now()).encode()).hexdigest()[:8].upper()
+    return "TKT-" + secrets.token_hex(4).upper()
 
 
 def safe_str(x):
     return "" if x is None else str(x)
 
 
-def append_cita(ws, row_dict: dict):
+def append_citas(ws, rows: list):
     """
+    Agrega varias citas en una sola llamada (append_rows).
     RAW para evitar que Sheets convierta datetimes a números.
     """
-    headers = ws.row_values(1)
-    row_dict = row_dict.copy()
+    if not rows:
+        return
+    headers = sheet_headers(ws)
+    if not set(COLUMNAS) <= set(headers):
+        headers = sheet_headers(ws, refrescar=True)
+
+    limpias = []
+    for row_dict in rows:
+        row_dict = row_dict.copy()
+        # Mantener texto (por seguridad)
+        for k in ["fecha_cita", "creado_en", "telefono_registro"]:
+            if k in row_dict and row_dict[k] != "":
+                row_dict[k] = str(row_dict[k]).lstrip("'")  # no duplicar apóstrofes
+        # Claves de cupo ya limpias al escribir (la lectura solo hace un strip vectorizado)
+        for k in ["fecha_cita", "turno", "estado"]:
+            if k in row_dict:
+                row_dict[k] = _norm_str(row_dict[k])
+        limpias.append(row_dict)
+
+    values = [[r.get(h, "") for h in headers] for r in limpias]
+    con_reintentos(
+        ws.append_rows, values,
+        value_input_option="RAW", insert_data_option="INSERT_ROWS", table_range="A1",
+        solo_cuota=True,
+    )
+    _read_all_cached.clear()
+    # Sin write-through local: si otra sesión agregó filas entre medio, la nuestra
+    # no quedó al final y el __row derivado de la copia apuntaría a otra cita
+    st.session_state.pop("df_cache", None)
 
-    # Mantener texto (por seguridad)
-    for k in ["fecha_cita", "creado_en", "telefono_registro"]:
-        if k in row_dict and row_dict[k] != "":
-            row_dict[k] = str(row_dict[k]).lstrip("'")  # no duplicar apóstrofes
 
-    row = [row_dict.get(h, "") for h in headers]
-    ws.append_row(row, value_input_option="RAW")
+def append_cita(ws, row_dict: dict):
+    append_citas(ws, [row_dict])
 
 
-def update_estado_por_row(ws, row_number: int, nuevo_estado: str):
-    headers = ws.row_values(1)
+def update_estados_por_row(ws, cambios: list):
+    """
+    cambios: [(row_number, nuevo_estado), ...] -> una sola llamada batch_update.
+    """
+    if not cambios:
+        return
+    headers = sheet_headers(ws)
+    if "estado" not in headers:
+        headers = sheet_headers(ws, refrescar=True)
     if "estado" not in headers:
         raise RuntimeError("No existe columna 'estado' en la hoja.")
     col_estado = headers.index("estado") + 1
-    ws.update_cell(row_number, col_estado, nuevo_estado)
+
+    data = [
+        {"range": gspread.utils.rowcol_to_a1(row_number, col_estado), "values": [[nuevo_estado]]}
+        for row_number, nuevo_estado in cambios
+    ]
+    con_reintentos(ws.batch_update, data, value_input_option="RAW")
+    _read_all_cached.clear()
+    for row_number, nuevo_estado in cambios:
+        _cache_set_estado(row_number, nuevo_estado)
 
 
 # ----------------------------
@@ -258,12 +419,14 @@ def semana_lun_sab(d: date):
 
 
 def fmt_fecha(d: date) -> str:
-    return d.strftime("%Y-%m-%d")
+    return d.isoformat()  # "%Y-%m-%d" para date, sin pasar por strftime
+
+
+_DIAS_ES = ("Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom")
 
 
 def nombre_dia_es(d: date) -> str:
-    dias = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
-    return dias[d.weekday()]
+    return _DIAS_ES[d.weekday()]
 
 
 # ----------------------------
@@ -276,22 +439,55 @@ def turnos_para_fecha(fecha_dt: date):
     return TURNOS_BASE
 
 
-def cupos_disponibles(df: pd.DataFrame, fecha: str, turno: str, capacidad: int) -> int:
-    if df.empty:
-        return capacidad
-    fecha = _norm_date_text(fecha)
-    turno = _norm_str(turno)
+def contar_usados(df: pd.DataFrame) -> pd.Series:
+    """
+    Citas que consumen cupo por (fecha_cita, turno), en un solo groupby.
+    Cancelados no consumen cupo. fecha/turno ya vienen normalizados de read_all.
+    """
+    activos = df[df["estado"] != "CANCELADO"]
+    return activos.groupby(["fecha_cita", "turno"], observed=True).size()
+
+
+def cupos_disponibles(usados: pd.Series, fecha: str, turno: str, capacidad: int) -> int:
+    n = usados.get((_norm_date_text(fecha), _norm_str(turno)), 0)
+    return max(0, capacidad - int(n))
 
-    sub = df[(df["fecha_cita"].astype(str).apply(_norm_date_text) == fecha) & (df["turno"].astype(str).apply(_norm_str) == turno)]
-    sub = sub[sub["estado"] != "CANCELADO"]  # cancelados no consumen cupo
-    usados = len(sub)
-    return max(0, capacidad - usados)
+
+def usados_en_turno(ws, fecha: str, turno: str) -> int:
+    """
+    Cuenta citas no canceladas de (fecha, turno) leyendo solo las columnas
+    fecha_cita / turno / estado, en vez de traer la hoja completa.
+    """
+    headers = sheet_headers(ws)
+    cols = ["fecha_cita", "turno", "estado"]
+    letras = [gspread.utils.rowcol_to_a1(1, headers.index(c) + 1)[:-1] for c in cols]
+    rangos = con_reintentos(ws.batch_get, [f"{l}2:{l}" for l in letras], major_dimension="COLUMNS")
+
+    valores = [(r[0] if r else []) for r in rangos]
+    n = max(len(v) for v in valores)
+    sub = pd.DataFrame({c: list(v) + [""] * (n - len(v)) for c, v in zip(cols, valores)})
+    if sub.empty:
+        return 0
+
+    # Mismas reglas que _read_sheet: ambos conteos deben ver las mismas filas
+    mask = (
+        (_norm_fecha(sub["fecha_cita"]) == _norm_date_text(fecha))
+        & (_norm_text(sub["turno"]) == _norm_str(turno))
+        & (_norm_text(sub["estado"]) != "CANCELADO")
+    )
+    return int(mask.sum())
+
+
+@st.cache_resource
+def _lock_registro() -> threading.Lock:
+    # Un lock por proceso (todas las sesiones comparten el servidor Streamlit)
+    return threading.Lock()
 
 
-def turnos_disponibles(df: pd.DataFrame, fecha_dt: date, fecha_str: str):
+def turnos_disponibles(usados: pd.Series, fecha_dt: date, fecha_str: str):
     opciones = []
     for t in turnos_para_fecha(fecha_dt):
-        libres = cupos_disponibles(df, fecha_str, t["turno"], t["capacidad"])
+        libres = cupos_disponibles(usados, fecha_str, t["turno"], t["capacidad"])
         if libres > 0:
             opciones.append((t["turno"], t["horario"], libres, t["capacidad"]))
     return opciones
@@ -300,15 +496,45 @@ def turnos_disponibles(df: pd.DataFrame, fecha_dt: date, fecha_str: str):
 # ----------------------------
 # PDF Ticket (PRO con logo + fondo)  ✅ LOGO CORREGIDO
 # ----------------------------
-def make_ticket_pdf_bytes(ticket_data: dict) -> bytes:
+@st.cache_resource
+def _io_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def _pdf_images():
+    """
+    ImageReader de fondo y logo, decodificados una sola vez por proceso.
+    """
+    from reportlab.lib.utils import ImageReader
+
+    def _load(path: Path):
+        if not path.exists():
+            return None
+        try:
+            return ImageReader(str(path))
+        except Exception:
+            return None
+
+    return _load(FONDO_PATH), _load(LOGO_PATH)
+
+
+def _render_ticket_pdf(ticket_data: dict, fondo_img, logo_img) -> bytes:
+    """
+    Dibuja el ticket. No usa nada de Streamlit: se puede correr en un hilo aparte.
+    """
+    from reportlab.lib.pagesizes import A6
+    from reportlab.pdfgen import canvas
+    from reportlab.lib import colors
+
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=A6)
     width, height = A6
 
     # 1) Fondo
-    if FONDO_PATH.exists():
+    if fondo_img is not None:
         try:
-            c.drawImage(ImageReader(str(FONDO_PATH)), 0, 0, width=width, height=height, mask="auto")
+            c.drawImage(fondo_img, 0, 0, width=width, height=height, mask="auto")
         except Exception:
             pass
 
@@ -347,9 +573,9 @@ def make_ticket_pdf_bytes(ticket_data: dict) -> bytes:
 
     # Logo (ajuste proporcional)
     logo_drawn_w = 0
-    if LOGO_PATH.exists():
+    if logo_img is not None:
         try:
-            img = ImageReader(str(LOGO_PATH))
+            img = logo_img
             iw, ih = img.getSize()
 
             max_w = 120
@@ -397,28 +623,30 @@ def make_ticket_pdf_bytes(ticket_data: dict) -> bytes:
     label_x = card_x + 16
     value_x = card_x + 92
 
+    filas = [
+        ("Ticket", ticket_data.get("id_ticket", "")),
+        ("Fecha", ticket_data.get("fecha_cita", "")),
+        ("Turno", f"{ticket_data.get('turno','')} ({ticket_data.get('horario_turno','')})"),
+        ("Placa tracto", ticket_data.get("placa_tracto", "")),
+        ("Placa carreta", ticket_data.get("placa_carreta", "")),
+        ("Chofer", ticket_data.get("chofer_nombre", "")),
+        ("Licencia", ticket_data.get("licencia", "")),
+        ("Transporte", ticket_data.get("transporte", "")),
+        ("Operación", ticket_data.get("tipo_operacion", "")),
+        ("Estado", ticket_data.get("estado", "")),
+        ("Registrado por", ticket_data.get("registrado_por", "")),
+        ("Teléfono", ticket_data.get("telefono_registro", "")),
+    ]
+    ys = [y - 13 * i for i in range(len(filas))]
+
+    # Una pasada por fuente (etiquetas en negrita, luego valores) en vez de alternar por fila
     c.setFont("Helvetica-Bold", 9.5)
-
-    def row(lbl: str, val: str):
-        nonlocal y
-        c.setFont("Helvetica-Bold", 9.5)
-        c.drawString(label_x, y, f"{lbl}:")
-        c.setFont("Helvetica", 9.5)
-        c.drawString(value_x, y, safe_str(val))
-        y -= 13
-
-    row("Ticket", ticket_data.get("id_ticket", ""))
-    row("Fecha", ticket_data.get("fecha_cita", ""))
-    row("Turno", f"{ticket_data.get('turno','')} ({ticket_data.get('horario_turno','')})")
-    row("Placa tracto", ticket_data.get("placa_tracto", ""))
-    row("Placa carreta", ticket_data.get("placa_carreta", ""))
-    row("Chofer", ticket_data.get("chofer_nombre", ""))
-    row("Licencia", ticket_data.get("licencia", ""))
-    row("Transporte", ticket_data.get("transporte", ""))
-    row("Operación", ticket_data.get("tipo_operacion", ""))
-    row("Estado", ticket_data.get("estado", ""))
-    row("Registrado por", ticket_data.get("registrado_por", ""))
-    row("Teléfono", ticket_data.get("telefono_registro", ""))
+    for (lbl, _val), fy in zip(filas, ys):
+        c.drawString(label_x, fy, f"{lbl}:")
+    c.setFont("Helvetica", 9.5)
+    for (_lbl, val), fy in zip(filas, ys):
+        c.drawString(value_x, fy, safe_str(val))
+    y -= 13 * len(filas)
 
     # Línea separadora
     c.setLineWidth(0.8)
@@ -444,6 +672,47 @@ def make_ticket_pdf_bytes(ticket_data: dict) -> bytes:
     return buffer.read()
 
 
+# ----------------------------
+# Dashboard: figuras cacheadas
+# ----------------------------
+# Reciben tuplas (hashables) para que st.cache_data no reconstruya la figura
+# cuando solo cambia un widget ajeno a los datos.
+@st.cache_data(show_spinner=False, max_entries=32)
+def _fig_donut(counts: tuple):
+    import plotly.express as px
+
+    data = pd.DataFrame(list(counts), columns=["estado", "cantidad"])
+    fig = px.pie(data, names="estado", values="cantidad", hole=0.55)
+    fig.update_traces(textinfo="label+percent+value")
+    return fig
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _fig_stack(rows: tuple):
+    import plotly.express as px
+
+    data = pd.DataFrame(list(rows), columns=["dia", "estado", "cantidad"])
+    fig = px.bar(data, x="dia", y="cantidad", color="estado", barmode="stack", text="cantidad")
+    fig.update_traces(textposition="outside")
+    fig.update_layout(yaxis_title="Cantidad", xaxis_title="Día")
+    return fig
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _fig_barras(counts: tuple, x_col: str, x_title: str):
+    import plotly.express as px
+
+    data = pd.DataFrame(list(counts), columns=[x_col, "cantidad"])
+    fig = px.bar(data, x=x_col, y="cantidad", text="cantidad")
+    fig.update_traces(textposition="outside")
+    fig.update_layout(xaxis_title=x_title, yaxis_title="Cantidad")
+    return fig
+
+
+def _as_tuple(df: pd.DataFrame) -> tuple:
+    return tuple(df.itertuples(index=False, name=None))
+
+
 # ----------------------------
 # UI
 # ----------------------------
@@ -499,7 +768,8 @@ with tab_selected[0]:
     fecha_sel = opciones_fecha[fecha_label]
     fecha_str = fmt_fecha(fecha_sel)
 
-    disponibles = turnos_disponibles(df, fecha_sel, fecha_str)
+    usados = contar_usados(df)
+    disponibles = turnos_disponibles(usados, fecha_sel, fecha_str)
     if not disponibles:
         st.warning("No hay cupos disponibles para esa fecha (todos los turnos están llenos).")
         st.stop()
@@ -509,66 +779,82 @@ with tab_selected[0]:
     idx = turno_labels.index(choice)
     turno_sel, horario_sel, libres_sel, cap_sel = disponibles[idx]
 
-    col1, col2 = st.columns(2)
-    with col1:
-        placa_tracto = st.text_input("Placa tracto *")
-        placa_carreta = st.text_input("Placa carreta")
-        chofer = st.text_input("Chofer *")
-        licencia = st.text_input("Licencia")
-    with col2:
-        transporte = st.text_input("Transporte")
-        tipo = st.selectbox("Tipo de operación", ["Carga", "Descarga", "Importación", "Exportación"])
-        obs = st.text_area("Observación")
-
-    st.markdown("### Información de registro")
-    registrado_por = st.text_input("Registrado por *")
-    telefono_registro = st.text_input("Teléfono (opcional)")
-
-    # Recalcular cupos “en vivo” con data fresca
-    df_now_for_cupos = read_all(ws)
-    libres_live = cupos_disponibles(df_now_for_cupos, fecha_str, turno_sel, cap_sel)
+    # Cupos “en vivo”: df se leyó al inicio de este mismo rerun
+    libres_live = cupos_disponibles(usados, fecha_str, turno_sel, cap_sel)
 
     st.info(f"✅ Quedan **{libres_live} cupos** en **{turno_sel} ({horario_sel})** para **{fecha_str}**")
 
-    if st.button("✅ Generar ticket y registrar"):
+    # Formulario: los campos no disparan reruns al escribir, solo al enviar.
+    # Fecha y turno quedan fuera para que los cupos se recalculen al cambiarlos.
+    with st.form("reg_form", clear_on_submit=False):
+        col1, col2 = st.columns(2)
+        with col1:
+            placa_tracto = st.text_input("Placa tracto *")
+            placa_carreta = st.text_input("Placa carreta")
+            chofer = st.text_input("Chofer *")
+            licencia = st.text_input("Licencia")
+        with col2:
+            transporte = st.text_input("Transporte")
+            tipo = st.selectbox("Tipo de operación", TIPOS_OPERACION)
+            obs = st.text_area("Observación")
+
+        st.markdown("### Información de registro")
+        registrado_por = st.text_input("Registrado por *")
+        telefono_registro = st.text_input("Teléfono (opcional)")
+
+        submitted = st.form_submit_button("✅ Generar ticket y registrar")
+
+    if submitted:
         if not placa_tracto or not chofer:
             st.error("Placa tracto y chofer son obligatorios.")
         elif not registrado_por.strip():
             st.error("El campo **Registrado por** es obligatorio.")
         else:
-            # validar cupo justo antes de registrar
-            df_now = read_all(ws)
-            libres_now = cupos_disponibles(df_now, fecha_str, turno_sel, cap_sel)
+            # Revalidar + append bajo el lock del proceso: dos choferes no pueden
+            # pasar el chequeo a la vez y tomar el último cupo
+            with _lock_registro():
+                # validar cupo justo antes de registrar (lectura angosta; si falla, hoja completa)
+                try:
+                    libres_now = max(0, cap_sel - usados_en_turno(ws, fecha_str, turno_sel))
+                except Exception:
+                    # Lectura completa sin caché: bajo el lock no sirve la copia de la sesión
+                    libres_now = cupos_disponibles(contar_usados(_read_sheet(ws)), fecha_str, turno_sel, cap_sel)
+                if libres_now > 0:
+                    ticket = generar_ticket()
+                    data = {
+                        "id_ticket": ticket,
+                        "turno": turno_sel,
+                        "horario_turno": horario_sel,
+                        "placa_tracto": _norm_str(placa_tracto).upper(),
+                        "placa_carreta": _norm_str(placa_carreta).upper(),
+                        "chofer_nombre": _norm_str(chofer),
+                        "licencia": _norm_str(licencia),
+                        "transporte": _norm_str(transporte),
+                        "tipo_operacion": tipo,
+                        "fecha_cita": fecha_str,
+                        "hora_cita": "",
+                        "observacion": _norm_str(obs),
+                        "estado": "EN COLA",
+                        "creado_en": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "registrado_por": _norm_str(registrado_por),
+                        "telefono_registro": _norm_str(telefono_registro),
+                    }
+
+                    # El PDF se dibuja mientras viaja el append (no depende del resultado);
+                    # si el append falla, el PDF se descarta
+                    pdf_futuro = _io_pool().submit(_render_ticket_pdf, data, *_pdf_images())
+                    append_cita(ws, data)
+
             if libres_now <= 0:
                 st.error("Se agotó el cupo justo ahora. Elige otro turno.")
             else:
-                ticket = generar_ticket()
-                data = {
-                    "id_ticket": ticket,
-                    "turno": turno_sel,
-                    "horario_turno": horario_sel,
-                    "placa_tracto": placa_tracto.strip().upper(),
-                    "placa_carreta": placa_carreta.strip().upper(),
-                    "chofer_nombre": chofer.strip(),
-                    "licencia": safe_str(licencia).strip(),
-                    "transporte": safe_str(transporte).strip(),
-                    "tipo_operacion": tipo,
-                    "fecha_cita": fecha_str,
-                    "hora_cita": "",
-                    "observacion": safe_str(obs).strip(),
-                    "estado": "EN COLA",
-                    "creado_en": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "registrado_por": registrado_por.strip(),
-                    "telefono_registro": telefono_registro.strip(),
-                }
-
-                append_cita(ws, data)
-
                 # Guardar en session_state para que NO se borre
                 st.session_state["last_ticket_data"] = data
-                st.session_state["last_pdf_bytes"] = make_ticket_pdf_bytes(data)
+                st.session_state["last_pdf_bytes"] = pdf_futuro.result()
 
-                st.success(f"🎟️ Ticket creado: **{ticket}**")
+                # Se agregó exactamente una fila: no hace falta releer la hoja
+                libres_after = libres_now - 1
+                st.success(f"🎟️ Ticket creado: **{ticket}** — quedan {libres_after} cupos en {turno_sel}")
 
     # Mostrar resumen + PDF SIEMPRE que exista (aunque se recargue la página)
     if st.session_state["last_ticket_data"]:
@@ -601,34 +887,36 @@ with tab_selected[0]:
 # TAB 2: Panel admin
 # ----------------------------
 if admin_ok:
-    with tab_selected[1]:
-        df = read_all(ws)
+    # Fragmento: filtros y editor solo rerunean este panel, no la app entera
+    @st.fragment
+    def _panel_admin():
+        # __row se asigna sobre la hoja completa, antes de filtrar (header=1)
+        df_admin = read_all(ws).reset_index(drop=True)
+        df_admin["__row"] = df_admin.index + 2
 
         st.subheader("Panel de control (Admin)")
 
-        df_admin = df.copy()
-
         colf1, colf2, colf3 = st.columns(3)
         with colf1:
             filtro_fecha = st.text_input("Filtrar fecha (YYYY-MM-DD)", "")
         with colf2:
-            filtro_estado = st.selectbox("Filtrar estado", ["(Todos)"] + ESTADOS, index=0)
+            filtro_estado = st.selectbox("Filtrar estado", FILTRO_ESTADOS, index=0)
         with colf3:
-            filtro_turno = st.selectbox("Filtrar turno", ["(Todos)"] + [t["turno"] for t in TURNOS_BASE], index=0)
+            filtro_turno = st.selectbox("Filtrar turno", FILTRO_TURNOS, index=0)
 
+        # Una sola máscara: un único recorte del DataFrame en vez de uno por filtro
+        mask = pd.Series(True, index=df_admin.index)
         if filtro_fecha:
-            df_admin = df_admin[df_admin["fecha_cita"].astype(str).str.contains(filtro_fecha.strip())]
+            mask &= df_admin["fecha_cita"].str.contains(filtro_fecha.strip(), regex=False, na=False)
         if filtro_estado != "(Todos)":
-            df_admin = df_admin[df_admin["estado"] == filtro_estado]
+            mask &= df_admin["estado"] == filtro_estado
         if filtro_turno != "(Todos)":
-            df_admin = df_admin[df_admin["turno"] == filtro_turno]
+            mask &= df_admin["turno"] == filtro_turno
+        df_admin = df_admin[mask]
 
         st.caption("✅ Cambia el estado directamente en la tabla y luego pulsa **Guardar cambios**.")
 
-        df_full = read_all(ws).reset_index(drop=True)
-        df_full["__row"] = df_full.index + 2  # header=1
-
-        df_admin = df_admin.merge(df_full[["id_ticket", "__row"]], on="id_ticket", how="left")
+        df_admin = df_admin.reset_index(drop=True)
 
         edited = st.data_editor(
             df_admin,
@@ -644,36 +932,39 @@ if admin_ok:
 
         if st.button("💾 Guardar cambios de estado"):
             try:
-                merged = edited.merge(df_admin[["id_ticket", "estado"]], on="id_ticket", suffixes=("_new", "_old"))
-                cambios = merged[merged["estado_new"] != merged["estado_old"]]
+                # edited y df_admin están alineados fila a fila (el editor no agrega ni quita filas)
+                changed_mask = edited["estado"].astype(str).to_numpy() != df_admin["estado"].astype(str).to_numpy()
+                cambios = edited.loc[changed_mask, ["__row", "estado"]]
 
                 if cambios.empty:
                     st.info("No hay cambios.")
                 else:
-                    for _, r in cambios.iterrows():
-                        update_estado_por_row(ws, int(r["__row"]), r["estado_new"])
+                    update_estados_por_row(
+                        ws,
+                        list(zip(cambios["__row"].astype(int).tolist(), cambios["estado"].astype(str).tolist())),
+                    )
                     st.success(f"Estados actualizados: {len(cambios)}")
                     st.rerun()
             except Exception:
                 st.error("Error actualizando estados. Revisa permisos y vuelve a intentar.")
 
+    with tab_selected[1]:
+        _panel_admin()
+
 
 # ----------------------------
 # TAB 3: Dashboard gerencia
 # ----------------------------
 if admin_ok:
-    with tab_selected[2]:
-        df = read_all(ws)
+    # Fragmento: cambiar de semana recalcula solo el dashboard
+    @st.fragment
+    def _dashboard():
+        df_dash = read_all(ws)
         st.subheader("Dashboard (Gerencia)")
 
-        df_dash = df.copy()
-
-        # parse robusto de fechas
-        df_dash["fecha_cita_dt"] = pd.to_datetime(
-            df_dash["fecha_cita"].astype(str).apply(_norm_date_text),
-            errors="coerce",
-            dayfirst=True,
-        ).dt.date
+        # datetime64 (sin .dt.date): filtros y groupby sobre int64, no objetos date.
+        # read_all ya dejó fecha_cita en "%Y-%m-%d"; lo que no calce no es fecha.
+        df_dash["fecha_cita_dt"] = pd.to_datetime(df_dash["fecha_cita"], format="%Y-%m-%d", errors="coerce")
 
         hoy = date.today()
         start_week, _days = semana_lun_sab(hoy)
@@ -688,106 +979,106 @@ if admin_ok:
             max_value=max_d,
         )
         start_week, days = semana_lun_sab(semana_base)
-        set_days = set(days)
+        start_ts = pd.Timestamp(start_week)
+        end_ts = start_ts + pd.Timedelta(days=6)  # lunes..sábado
 
-        df_w = df_dash[df_dash["fecha_cita_dt"].isin(set_days)].copy()
+        df_w = df_dash[df_dash["fecha_cita_dt"].between(start_ts, end_ts, inclusive="left")]
 
         if df_w.empty and not df_dash.empty:
             st.warning("⚠️ No hay registros en la semana seleccionada. Mostrando resumen general (todos los registros).")
-            df_w = df_dash.copy()
+            df_w = df_dash
+
+        # Un solo conteo de estados para las métricas y el gráfico
+        vc_estado = df_w["estado"].value_counts(sort=False)
 
         total = len(df_w)
         k1, k2, k3, k4, k5 = st.columns(5)
         k1.metric("Total", total)
-        k2.metric("En cola", int((df_w["estado"] == "EN COLA").sum()))
-        k3.metric("En proceso", int((df_w["estado"] == "EN PROCESO").sum()))
-        k4.metric("Atendido", int((df_w["estado"] == "ATENDIDO").sum()))
-        k5.metric("Cancelado", int((df_w["estado"] == "CANCELADO").sum()))
+        k2.metric("En cola", int(vc_estado.get("EN COLA", 0)))
+        k3.metric("En proceso", int(vc_estado.get("EN PROCESO", 0)))
+        k4.metric("Atendido", int(vc_estado.get("ATENDIDO", 0)))
+        k5.metric("Cancelado", int(vc_estado.get("CANCELADO", 0)))
 
         st.markdown("### Distribución de estados (rápido)")
         estado_counts = (
-            df_w["estado"].value_counts()
-            .reindex(ESTADOS)
-            .fillna(0)
-            .astype(int)
-            .reset_index()
+            vc_estado
+            .reindex(list(ESTADOS), fill_value=0)
+            .rename_axis("estado")
+            .reset_index(name="cantidad")
         )
-        estado_counts.columns = ["estado", "cantidad"]
 
         if estado_counts["cantidad"].sum() == 0:
             st.info("No hay datos para graficar en esta selección.")
         else:
-            fig_donut = px.pie(estado_counts, names="estado", values="cantidad", hole=0.55)
-            fig_donut.update_traces(textinfo="label+percent+value")
+            fig_donut = _fig_donut(_as_tuple(estado_counts))
             st.plotly_chart(fig_donut, use_container_width=True)
 
         st.markdown("### Unidades por día (Lunes–Sábado) y por estado")
-        cal = pd.DataFrame([{"fecha": d, "dia": f"{nombre_dia_es(d)} {d.strftime('%d/%m')}"} for d in days])
-
-        grp = df_w.groupby(["fecha_cita_dt", "estado"]).size().reset_index(name="cantidad")
-        grp = grp.merge(cal, left_on="fecha_cita_dt", right_on="fecha", how="right")
-        grp["cantidad"] = grp["cantidad"].fillna(0).astype(int)
-
-        full = []
-        for d in days:
-            dia_label = f"{nombre_dia_es(d)} {d.strftime('%d/%m')}"
-            for est in ESTADOS:
-                sub = grp[(grp["fecha"] == d) & (grp["estado"] == est)]
-                full.append(
-                    {"dia": dia_label, "estado": est, "cantidad": int(sub["cantidad"].iloc[0]) if not sub.empty else 0}
-                )
-        full_df = pd.DataFrame(full)
+        idx = pd.MultiIndex.from_product([pd.to_datetime(days), ESTADOS], names=["fecha", "estado"])
+        full_df = (
+            df_w.groupby(["fecha_cita_dt", "estado"], observed=True).size()
+            .reindex(idx, fill_value=0)
+            .reset_index(name="cantidad")
+        )
+        full_df["dia"] = full_df["fecha"].map(lambda d: f"{nombre_dia_es(d)} {d.strftime('%d/%m')}")
 
         if full_df["cantidad"].sum() == 0:
             st.info("No hay datos para graficar por día en esta selección.")
         else:
-            fig_stack = px.bar(full_df, x="dia", y="cantidad", color="estado", barmode="stack", text="cantidad")
-            fig_stack.update_traces(textposition="outside")
-            fig_stack.update_layout(yaxis_title="Cantidad", xaxis_title="Día")
+            fig_stack = _fig_stack(_as_tuple(full_df[["dia", "estado", "cantidad"]]))
             st.plotly_chart(fig_stack, use_container_width=True)
 
         st.markdown("### Citas por turno (semanal)")
         turno_counts = (
-            df_w["turno"].value_counts()
-            .reindex([t["turno"] for t in TURNOS_BASE])
-            .fillna(0)
-            .astype(int)
-            .reset_index()
+            df_w["turno"].value_counts(sort=False)
+            .reindex(list(TURNO_NAMES), fill_value=0)
+            .rename_axis("turno")
+            .reset_index(name="cantidad")
         )
-        turno_counts.columns = ["turno", "cantidad"]
 
         if turno_counts["cantidad"].sum() == 0:
             st.info("No hay datos para graficar por turnos en esta selección.")
         else:
-            fig_turnos = px.bar(turno_counts, x="turno", y="cantidad", text="cantidad")
-            fig_turnos.update_traces(textposition="outside")
-            fig_turnos.update_layout(xaxis_title="Turno", yaxis_title="Cantidad")
+            fig_turnos = _fig_barras(_as_tuple(turno_counts), "turno", "Turno")
             st.plotly_chart(fig_turnos, use_container_width=True)
 
         st.markdown("### Operación (tipo) — semanal")
-        op_counts = df_w["tipo_operacion"].value_counts().reset_index()
-        op_counts.columns = ["tipo_operacion", "cantidad"]
+        vc_ops = df_w["tipo_operacion"].value_counts()
+        op_counts = (
+            vc_ops[vc_ops > 0]  # Categorical incluye tipos sin citas
+            .rename_axis("tipo_operacion")
+            .reset_index(name="cantidad")
+        )
 
         if op_counts["cantidad"].sum() == 0:
             st.info("No hay datos para graficar por operación en esta selección.")
         else:
-            fig_ops = px.bar(op_counts, x="tipo_operacion", y="cantidad", text="cantidad")
-            fig_ops.update_traces(textposition="outside")
-            fig_ops.update_layout(xaxis_title="Operación", yaxis_title="Cantidad")
+            fig_ops = _fig_barras(_as_tuple(op_counts), "tipo_operacion", "Operación")
             st.plotly_chart(fig_ops, use_container_width=True)
 
         st.markdown("### Descargar reporte (Excel)")
-        out = BytesIO()
-        with pd.ExcelWriter(out, engine="openpyxl") as writer:
-            df_w.drop(columns=["fecha_cita_dt"], errors="ignore").to_excel(writer, index=False, sheet_name="Citas")
-            estado_counts.to_excel(writer, index=False, sheet_name="Resumen_estados")
-            turno_counts.to_excel(writer, index=False, sheet_name="Turnos")
-            op_counts.to_excel(writer, index=False, sheet_name="Operaciones")
-        out.seek(0)
+        # El XLSX solo se arma a pedido (no en cada rerun); queda en session_state con la
+        # semana y una huella de los datos: si llegan citas o cambian estados, se descarta
+        huella = (start_week, len(df_w), int(pd.util.hash_pandas_object(df_w, index=False).sum()))
+        if st.button("📊 Preparar reporte"):
+            out = BytesIO()
+            # xlsxwriter escribe directo al buffer (sin árbol de celdas como openpyxl).
+            # No usamos constant_memory: pandas escribe por columnas y ese modo solo acepta filas en orden.
+            with pd.ExcelWriter(out, engine="xlsxwriter") as writer:
+                df_w.drop(columns=["fecha_cita_dt"]).to_excel(writer, index=False, sheet_name="Citas")
+                estado_counts.to_excel(writer, index=False, sheet_name="Resumen_estados")
+                turno_counts.to_excel(writer, index=False, sheet_name="Turnos")
+                op_counts.to_excel(writer, index=False, sheet_name="Operaciones")
+            st.session_state["reporte_xlsx"] = (huella, out.getvalue())
+
+        reporte = st.session_state.get("reporte_xlsx")
+        if reporte and reporte[0] == huella:
+            st.download_button(
+                "⬇️ Descargar reporte (XLSX)",
+                data=reporte[1],
+                file_name=f"reporte_citas_{start_week.strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
 
-        st.download_button(
-            "⬇️ Descargar reporte (XLSX)",
-            data=out.getvalue(),
-            file_name=f"reporte_citas_{start_week.strftime('%Y%m%d')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+    with tab_selected[2]:
+        _dashboard()